@@ -3,9 +3,12 @@
 """Ennio is a framework for creating re-usable deployment scripts."""
 import sys
 
+__version__ = "0.1.2"
+
 from .app import EnnioApplication
 from .stack import EnnioStack
 from .utils import (
+    ChangeSummary,
     LazyBoto3Client,
     require_aws,
     setup_logging,
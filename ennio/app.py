@@ -7,61 +7,287 @@ Predefined commands:
 
 compile: generate templates.
 deploy: deploy specified stack
+deploy-changed: deploy stacks affected by files changed since a git revision
 delete: delete specified stack
+gc-changesets: remove stale changesets in all namespaces
 """
+from datetime import datetime, timedelta
 from pathlib import Path
 import argparse
+import contextlib
+import hashlib
 import importlib
 import inspect
 import logging
 import os
+import pickle
+import subprocess
 import sys
+import time
 
 from botocore.exceptions import ClientError
 import yaml
 
-from .utils import InvalidConfigError, LazyBoto3Client
+from . import __version__
+from .lock import FileLockStore, LeaseLock, S3LockStore
+from .profiling import Profiler
+from .utils import (
+    DeadlineExceededError,
+    InvalidConfigError,
+    LazyBoto3Client,
+    chunks,
+    match_path,
+    parallel_map,
+)
 
 
 display_name = lambda name: name.replace("_", "-")
 method_name = lambda name: name.replace("-", "_")
 
 
+# libyaml is a lot faster when it is available.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 class EnnioConfig:
-    """Represents a configuration yaml file for ennio."""
+    """
+    Represents a configuration yaml file for ennio.
+
+    An item in `stacks` can be `include: <glob>` instead of a stack, to read
+    stacks from other yaml files, relative to the config file. Each of these
+    files holds a stack or a list of stacks.
+
+    Validated configs are cached in `ENNIO_CACHE_DIR`, default to
+    `~/.cache/ennio`, keyed on hashes of all files read. Set `ENNIO_NO_CACHE`
+    to `true` in env var to disable the cache. Cache files are pickles, so
+    the cache directory is only used when it is private to the current
+    user.
+    """
+
+    # Caches of other ennio releases are not used, defaults and validation
+    # might differ. Bump the suffix when the cache format changes.
+    CACHE_VERSION = f"{__version__}-2"
 
     def __init__(self, conf_file):
         conf_file = Path(conf_file)
-        logging.debug(f"Reading conf file: {conf_file.resolve()}.")
-        with open(conf_file) as fobj:
-            self.data = yaml.load(fobj, Loader=yaml.SafeLoader)
+        self.path = conf_file
+        # hashes of the config file and all included files.
+        self.files = {}
+        # include patterns found in the config file.
+        self.patterns = []
+
+        self.data = self.load_cache()
+        if self.data is None:
+            logging.debug(f"Reading conf file: {conf_file.resolve()}.")
+            self.data = self.load()
+            self.stacks = [
+                stack.get("name")
+                for stack in self.data.get("stacks", [])
+                if isinstance(stack, dict)
+            ]
+            self.prefixes = self.stacks + ["application"]
+            self.validate()
+            self.set_defaults()
+            self.save_cache()
 
         self.stacks = [stack["name"] for stack in self.data["stacks"]]
         self.prefixes = self.stacks + ["application"]
-        self.validate()
-        self.set_defaults()
 
     def __getitem__(self, name):
         """Pass the dict lookup to self.data."""
         return self.data[name]
 
+    def read(self, path):
+        """Parse a yaml file, keep a hash of it for the cache."""
+        content = Path(path).read_bytes()
+        self.files[str(path)] = hashlib.sha256(content).hexdigest()
+        return yaml.load(content, Loader=YamlLoader)
+
+    def includes(self, patterns):
+        """List files that matches the include patterns."""
+        root = self.path.resolve().parent
+        return [
+            path for pattern in patterns for path in sorted(root.glob(pattern))
+        ]
+
+    def load(self):
+        """Load the config file, along with the included stack files."""
+        data = self.read(self.path.resolve())
+        if not isinstance(data, dict):
+            raise InvalidConfigError("Config is not a mapping.")
+
+        stacks = []
+        for stack in data.get("stacks", []):
+            if not isinstance(stack, dict) or "include" not in stack:
+                stacks.append(stack)
+                continue
+            self.patterns.append(stack["include"])
+            for path in self.includes([stack["include"]]):
+                fragment = self.read(path)
+                if isinstance(fragment, list):
+                    stacks.extend(fragment)
+                else:
+                    stacks.append(fragment)
+        if "stacks" in data:
+            data["stacks"] = stacks
+        return data
+
+    @property
+    def cache_file(self):
+        """Path of the cache file of this config file."""
+        directory = os.environ.get(
+            "ENNIO_CACHE_DIR", os.path.expanduser("~/.cache/ennio")
+        )
+        name = hashlib.sha256(str(self.path.resolve()).encode()).hexdigest()
+        return Path(directory, f"config-{name}.pickle")
+
+    def cache_trusted(self):
+        """
+        Return whether the cache can not be written by other users.
+
+        Loading a pickle runs code, anyone who can write the cache could run
+        it in our deployments.
+        """
+        try:
+            directory = self.cache_file.parent.stat()
+            cached = self.cache_file.stat()
+        except OSError:
+            return False
+        if directory.st_uid != os.getuid() or cached.st_uid != os.getuid():
+            logging.warning(
+                f"Ignoring config cache not owned by us: {self.cache_file}."
+            )
+            return False
+        if directory.st_mode & 0o077:
+            logging.warning(
+                f"Ignoring config cache in {self.cache_file.parent}, the "
+                "directory is accessible by others, it should be mode 0700."
+            )
+            return False
+        return True
+
+    def load_cache(self):
+        """Load validated config from the cache if no file has changed."""
+        if os.environ.get("ENNIO_NO_CACHE", "false").lower() == "true":
+            return None
+        if not self.cache_trusted():
+            return None
+        try:
+            with open(self.cache_file, "rb") as fobj:
+                cached = pickle.load(fobj)
+        except Exception:
+            # Missing, unreadable or written by an incompatible version.
+            return None
+
+        if cached.get("version") != self.CACHE_VERSION:
+            return None
+        files = [str(self.path.resolve())] + [
+            str(path) for path in self.includes(cached["includes"])
+        ]
+        if sorted(files) != sorted(cached["files"]):
+            return None
+        for path in files:
+            try:
+                content = Path(path).read_bytes()
+            except OSError:
+                return None
+            if hashlib.sha256(content).hexdigest() != cached["files"][path]:
+                return None
+
+        logging.debug(f"Using cached config: {self.cache_file}.")
+        self.files = cached["files"]
+        self.patterns = cached["includes"]
+        return cached["data"]
+
+    def save_cache(self):
+        """Save the validated config to the cache, ignore any failure."""
+        if os.environ.get("ENNIO_NO_CACHE", "false").lower() == "true":
+            return
+        cached = {
+            "version": self.CACHE_VERSION,
+            "includes": self.patterns,
+            "files": self.files,
+            "data": self.data,
+        }
+        try:
+            directory = self.cache_file.parent
+            directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            with open(self.cache_file, "wb") as fobj:
+                pickle.dump(cached, fobj)
+        except (OSError, pickle.PicklingError) as err:
+            logging.debug(f"Failed to cache config: {err}")
+
     def validate(self):
-        """Validate our DSL."""
+        """Validate our DSL, report all errors found at once."""
+        errors = list(self.errors())
+        if errors:
+            raise InvalidConfigError(
+                "Invalid config:\n" + "\n".join(f"\t{e}" for e in errors)
+            )
+
+    def errors(self):
+        """Find errors in the config."""
         mandatory = ["application", "stacks", "deploy-steps"]
-        if any(field not in self.data for field in mandatory):
-            raise InvalidConfigError("Mandatory field missing in config.")
+        missing = [field for field in mandatory if field not in self.data]
+        if missing:
+            yield f"Mandatory field missing in config: {missing}."
+            return
 
         if "name" not in self.data["application"]:
-            raise InvalidConfigError(f"Undefined application name.")
+            yield f"Undefined application name."
+
+        seen = set()
+        for stack in self.data["stacks"]:
+            if not isinstance(stack, dict) or "name" not in stack:
+                yield f"Undefined stack name: {stack}."
+                continue
+            if "class" not in stack:
+                yield f"Undefined class of stack {stack['name']}."
+            if stack["name"] in seen:
+                yield f"Duplicate stack name: {stack['name']}."
+            seen.add(stack["name"])
+            for dependency in stack.get("depends_on", []):
+                if dependency not in self.stacks:
+                    yield (
+                        f"Invalid dependency of {stack['name']}: {dependency}."
+                    )
+        yield from self.cycles()
 
         for step in self.data["deploy-steps"]:
             if not self.validate_step(step):
-                raise InvalidConfigError(f"Invalid step defined: {step}.")
+                yield f"Invalid step defined: {step}."
 
         extra_commands = self.data.get("extra-commands", [])
         for command in extra_commands:
             if not self.is_valid_method(command):
-                raise InvalidConfigError(f"Invalid command defined: {command}.")
+                yield f"Invalid command defined: {command}."
+
+        lock = self.data["application"].get("lock", {})
+        if lock.get("scope", "namespace") not in ["namespace", "stack"]:
+            yield f"Invalid lock scope: {lock['scope']}."
+
+    def cycles(self):
+        """Find cycles in `depends_on` of stacks."""
+        graph = {
+            stack["name"]: stack.get("depends_on", [])
+            for stack in self.data["stacks"]
+            if isinstance(stack, dict) and "name" in stack
+        }
+        done = set()
+
+        def visit(name, path):
+            if name in path:
+                cycle = path[path.index(name) :] + [name]
+                yield f"Cyclic dependency: {' -> '.join(cycle)}."
+                return
+            if name in done or name not in graph:
+                return
+            for dependency in graph[name]:
+                yield from visit(dependency, path + [name])
+            done.add(name)
+
+        for name in graph:
+            yield from visit(name, [])
 
     def is_valid_method(self, method):
         """Return whether a method found in config is valid."""
@@ -96,6 +322,7 @@ class EnnioConfig:
 
     def set_defaults(self):
         """Setup default values for config."""
+        self.data.setdefault("extra-commands", [])
         for step in self.data["deploy-steps"]:
             step.setdefault("ignore_error", False)
 
@@ -104,9 +331,12 @@ class EnnioApplication:
     """Represents an application that has several cfn stacks as components."""
 
     NO_VERSION = "-1"
+    # Tag set on stacks deployed by ennio, its value is the application.
+    APP_TAG = "ennio:application"
 
     cfn = LazyBoto3Client("cloudformation")
     ssm = LazyBoto3Client("ssm")
+    s3 = LazyBoto3Client("s3")
 
     def __init__(self, conf_file):
         self.config = EnnioConfig(conf_file)
@@ -118,9 +348,8 @@ class EnnioApplication:
         self.stacks = {}
         for config in self.config["stacks"]:
             mod_str, klass = config["class"].rsplit(".", 1)
-            if mod_str not in sys.modules:
-                mod = importlib.import_module(mod_str)
-            stack_class = getattr(mod, klass)
+            # Modules already imported are taken from `sys.modules`.
+            stack_class = getattr(importlib.import_module(mod_str), klass)
             self.stacks[config["name"]] = stack_class(self, config)
 
         self.steps = self.parse_steps()
@@ -130,6 +359,10 @@ class EnnioApplication:
         }
 
         self._version = None
+        # datetime the running release has to finish by.
+        self.deadline = None
+        # set by the `--profile` option.
+        self.profiler = None
 
     def parse_steps(self):
         """Parse the `deploy-steps` section in the config."""
@@ -161,9 +394,11 @@ class EnnioApplication:
 
         step = {
             "name": config["stack"],
+            "stack": config["stack"],
             "deploy": stack.deploy,
             "rollback": stack.rollback,
             "delete": stack.delete,
+            "snapshot": stack.save_snapshot,
             "ignore_error": config["ignore_error"],
         }
 
@@ -184,6 +419,7 @@ class EnnioApplication:
 
         step = {
             "name": config["operation"],
+            "stack": config["operation"].split(".")[0],
             "deploy": method,
             "rollback": method,
             "delete": no_op,
@@ -206,6 +442,9 @@ class EnnioApplication:
 
         Parse command line arguments, find the method either from application
         class or a stack class, pass key word arguments to it and make it happen
+
+        With `--profile [directory]`, the command and each deploy step in it
+        are profiled, see `ennio.profiling`.
         """
         parsed = self.parse_args()
 
@@ -217,16 +456,19 @@ class EnnioApplication:
 
         params = inspect.signature(method).parameters
         for key, value in params.items():
-            if key not in parsed and value is not value.empty:
+            if key not in parsed and value.default is value.empty:
                 raise argparse.ArgumentTypeError(
                     f"`{parsed.command}` need argument `--{display_name(key)}`."
                 )
         kwargs = {
             name: getattr(parsed, name)
             for name in dir(parsed)
-            if ((not name.startswith("_")) and name != "command")
+            if not name.startswith("_") and name not in ["command", "profile"]
         }
-        method(**kwargs)
+        if parsed.profile is not None:
+            self.profiler = Profiler(parsed.profile)
+        with self.profile(parsed.command):
+            method(**kwargs)
 
     def parse_args(self):
         """
@@ -246,6 +488,13 @@ class EnnioApplication:
             metavar="command",
             choices=self.sub_commands,
         )
+        parser.add_argument(
+            "--profile",
+            help="Profile the command, write stacks to this directory",
+            metavar="directory",
+            nargs="?",
+            const="ennio-profile",
+        )
         parsed, unknown = parser.parse_known_args()
         for arg in unknown:
             if arg.startswith("--"):
@@ -266,6 +515,8 @@ class EnnioApplication:
         commands = {
             "delete-all": self.delete_all,
             "deploy-all": self.deploy_all,
+            "deploy-changed": self.deploy_changed,
+            "gc-changesets": self.gc_changesets,
         }
         for stack_name, stack in self.stacks.items():
             commands[f"deploy-{stack_name}"] = stack.deploy
@@ -354,6 +605,156 @@ class EnnioApplication:
     ##############################################
     # Helper methods
     ##############################################
+    def git(self, *args):
+        """Run a git command next to the config file, return its output."""
+        return subprocess.run(
+            ["git", *args],
+            cwd=self.config.path.resolve().parent,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout.strip()
+
+    def changed_files(self, since):
+        """List files changed since a git revision, relative to repo root."""
+        root = self.git("rev-parse", "--show-toplevel")
+        output = self.git("-C", root, "diff", "--name-only", since, "--")
+        return output.splitlines()
+
+    def repo_prefix(self):
+        """Directory of the config file, relative to the repo root."""
+        root = Path(self.git("rev-parse", "--show-toplevel")).resolve()
+        return self.config.path.resolve().parent.relative_to(root)
+
+    def commit_key(self, build):
+        """S3 key of the git commit a build was deployed from."""
+        return f"ennio-commits/{self.namespace}/{build}"
+
+    def save_commit(self, build):
+        """Record the git commit `build` is deployed from, if any."""
+        try:
+            commit = self.git("rev-parse", "HEAD")
+        except (OSError, subprocess.CalledProcessError):
+            logging.debug(f"Not in a git repository, no commit for {build}.")
+            return
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self.commit_key(build),
+                Body=commit.encode(),
+            )
+        except ClientError as error:
+            logging.warning(f"Failed to record commit of {build}: {error}")
+
+    def resolve_revision(self, since, build_only=False):
+        """
+        Resolve a git revision or a build to a git commit.
+
+        Builds are resolved through the commit recorded when they were
+        deployed, which wins over a git revision of the same name, as build
+        numbers can look like abbreviated hashes. With `build_only`, `since`
+        is not tried as a git revision. Return None when `since` can not be
+        resolved.
+        """
+        candidates = [] if build_only else [since]
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket, Key=self.commit_key(since)
+            )
+            candidates.insert(0, response["Body"].read().decode().strip())
+        except ClientError as error:
+            logging.debug(f"No commit recorded for {since}: {error}")
+
+        for candidate in candidates:
+            revision = f"{candidate}^{{commit}}"
+            try:
+                return self.git("rev-parse", "--verify", "--quiet", revision)
+            except (OSError, subprocess.CalledProcessError):
+                continue
+        return None
+
+    def affected_stacks(self, files, prefix="."):
+        """
+        Find stacks affected by changes in `files`, and their dependents.
+
+        A stack is affected when any file matches the `paths` in it's config.
+        Stacks that do not declare `paths` are always affected. `paths` are
+        relative to the config file, `files` to `prefix`, the directory of
+        the config file relative to where `files` are listed from.
+        """
+        affected = set()
+        for name, stack in self.stacks.items():
+            paths = stack.config.get("paths")
+            if paths is not None:
+                paths = [os.path.normpath(Path(prefix, p)) for p in paths]
+            if paths is None or any(
+                match_path(file_, path) for file_ in files for path in paths
+            ):
+                affected.add(name)
+
+        while True:
+            dependents = {
+                name
+                for name, stack in self.stacks.items()
+                if affected.intersection(stack.config.get("depends_on", []))
+            }
+            if dependents <= affected:
+                return affected
+            affected |= dependents
+
+    def profile(self, name):
+        """Profile a step named `name` if profiling is enabled."""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.step(name)
+
+    def check_lock(self, lock):
+        """
+        Abort if `lock` has been lost.
+
+        Another deployment may hold the lock by now, so there is no rollback
+        either, that would be racing with it.
+        """
+        if lock is None or not lock.lost.is_set():
+            return
+        logging.error(f"Lost lock {lock.name}, aborting without rollback.")
+        sys.exit(1)
+
+    def lock(self, name, scope):
+        """
+        Get a lease lock on `name`.
+
+        Locking is enabled by a `lock` section under `application` in the
+        config, with `scope` being either `namespace` (default) or `stack`.
+        A no-op context manager is returned if locking is disabled or not
+        for this scope. Waiting for the lock is bounded by the deadline of
+        the release, if any. Lock documents are kept in the application bucket,
+        or in `ENNIO_LOCK_DIR` when that is set in env var.
+        """
+        config = self.config["application"].get("lock")
+        if config is None or config.get("scope", "namespace") != scope:
+            return contextlib.nullcontext()
+
+        timeout = config.get("timeout", 3600)
+        if self.deadline is not None:
+            # Waiting for the lock counts towards the deadline.
+            remaining = (self.deadline - datetime.now()).total_seconds()
+            timeout = max(min(timeout, remaining), 0)
+
+        if os.environ.get("ENNIO_LOCK_DIR"):
+            path = os.path.join(os.environ["ENNIO_LOCK_DIR"], f"{name}.json")
+            store = FileLockStore(path)
+        else:
+            key = f"ennio-locks/{name}.json"
+            store = S3LockStore(self.s3, self.bucket, key)
+        return LeaseLock(
+            store,
+            name,
+            ttl=config.get("ttl", 60),
+            timeout=timeout,
+        )
+
     def rollback_all(self, changed):
         """Rollback all changed stacks."""
         if self.version == self.NO_VERSION:
@@ -373,21 +774,54 @@ class EnnioApplication:
     ##############################################
     # Operations
     ##############################################
-    def deploy_all(self, build):
-        """Update all stacks in a transaction."""
+    def deploy_all(self, build, deadline=None):
+        """
+        Update all stacks in a transaction.
+
+        `deadline` is the number of seconds the whole deployment has to
+        finish in, rollback is not counted.
+        """
+        self.start_deadline(deadline)
+        try:
+            with self.lock(self.namespace, "namespace") as lock:
+                self.deploy_steps(build, self.steps, lock)
+        finally:
+            self.deadline = None
+
+    def start_deadline(self, deadline):
+        """Start the deadline, in seconds, of a release."""
+        if deadline is not None:
+            self.deadline = datetime.now() + timedelta(seconds=int(deadline))
+            logging.info(f"Deployment has to finish by {self.deadline}.")
+
+    def deploy_steps(self, build, steps, lock=None):
+        """
+        Run deploy steps in a transaction, rollback all on failure.
+
+        `lock` is checked between steps, and the deployment is aborted once
+        it is lost.
+        """
         logging.info(f"Deploying {build}, current version: {self.version}.")
 
         changed = []
-        for step in self.steps:
+        for step in steps:
             logging.debug(f"running step: {step}")
             name = step["name"]
+            self.check_lock(lock)
             try:
+                if self.deadline is not None and datetime.now() > self.deadline:
+                    raise DeadlineExceededError(
+                        f"Deadline exceeded at {self.deadline}."
+                    )
                 logging.info(f"{name} deploy step started.")
-                step["deploy"](build)
+                with self.profile(name):
+                    step["deploy"](build)
                 logging.info(f"{name} deploy step finished.")
                 changed.append(step)
             except Exception as err:
                 logging.warning(f"{name} deploy step failed with: {err}")
+                if isinstance(err, DeadlineExceededError):
+                    break
                 if step["ignore_error"]:
                     # Not going to add this step to changed, because we failed
                     # to change it.
@@ -396,12 +830,19 @@ class EnnioApplication:
                 break
         else:
             # No break from for loop, all good.
+            self.check_lock(lock)
+            for step in changed:
+                if "snapshot" in step:
+                    step["snapshot"](build)
+            self.save_commit(build)
             self.version = build
             logging.info(
                 f"Deployment of application {self.name} completed successfully."
             )
             return
 
+        # Rollback is not bound by the deadline, it has to run to completion.
+        self.deadline = None
         if os.environ.get("ENNIO_NO_ROLLBACK", "false").lower() == "true":
             logging.warning(f"Rollback canceled by env var.")
         else:
@@ -409,20 +850,147 @@ class EnnioApplication:
             self.rollback_all(changed)
         sys.exit(1)
 
+    def deploy_changed(self, build, since=None, deadline=None):
+        """
+        Update stacks affected by changes since `since` in a transaction.
+
+        `since` is a git revision or a build, default to the current
+        version, which is only resolved as a build. Builds are resolved
+        through the git commit recorded when they were deployed, all steps
+        are run if that is not possible. Operation steps run when their
+        stack is affected, `application` operations run when any stack is
+        affected. `deadline` works as in `deploy_all`.
+        """
+        self.start_deadline(deadline)
+        try:
+            with self.lock(self.namespace, "namespace") as lock:
+                version = self.version
+                if since is None:
+                    affected = self.affected_since(version, build_only=True)
+                else:
+                    affected = self.affected_since(since)
+                if affected is None:
+                    self.deploy_steps(build, self.steps, lock)
+                    return
+
+                steps = [
+                    step
+                    for step in self.steps
+                    if step["stack"] in affected
+                    or (step["stack"] == "application" and affected)
+                ]
+                self.deploy_steps(build, steps, lock)
+
+                # Untouched stacks are the same as in the previous version.
+                for name, stack in self.stacks.items():
+                    if name not in affected:
+                        stack.copy_snapshot(version, build)
+        finally:
+            self.deadline = None
+
+    def affected_since(self, since, build_only=False):
+        """
+        Find stacks affected by changes since a git revision or a build.
+
+        Return None when everything has to be deployed.
+        """
+        if since == self.NO_VERSION:
+            logging.info("Deploying for the first time, deploying all.")
+            return None
+
+        revision = self.resolve_revision(since, build_only)
+        if revision is None:
+            logging.warning(f"Can not resolve {since}, deploying all.")
+            return None
+
+        files = self.changed_files(revision)
+        logging.info(f"{len(files)} files changed since {since}.")
+        affected = self.affected_stacks(files, self.repo_prefix())
+        logging.info(f"Affected stacks: {sorted(affected)}.")
+        return affected
+
     def delete_all(self):
         """Delete all stacks one by one."""
         logging.info(f"Removing stacks, current version: {self.version}.")
 
-        for step in reversed(self.steps):
-            logging.debug(f"running step: {step}")
-            name = step["name"]
+        with self.lock(self.namespace, "namespace"):
+            for step in reversed(self.steps):
+                logging.debug(f"running step: {step}")
+                name = step["name"]
+                try:
+                    logging.info(f"{name} delete step started.")
+                    step["delete"]()
+                    logging.info(f"{name} delete step finished.")
+                except Exception as err:
+                    logging.warning(f"{name} delete step failed with: {err}")
+                    break
+
+    def deployed_stacks(self):
+        """
+        Find stacks of this application in all namespaces.
+
+        A stack belongs to this application when its name is that of a
+        configured stack, prefixed with any namespace, and its `APP_TAG` is
+        the name of this application. Stacks of aborted first deployments
+        are found as well, as tags are set when the changeset is created.
+        """
+        deployed = {}
+        paginator = self.cfn.get_paginator("describe_stacks")
+        for page in paginator.paginate():
+            for response in page["Stacks"]:
+                name = response["StackName"]
+                tags = {
+                    tag["Key"]: tag["Value"] for tag in response.get("Tags", [])
+                }
+                if tags.get(self.APP_TAG) != self.name:
+                    continue
+                for stack in self.stacks.values():
+                    if stack.config.get("account_unique", False):
+                        matched = name == stack.stack_name
+                    else:
+                        matched = name.endswith(f"-{stack.name}")
+                    if matched:
+                        deployed[name] = stack
+                        break
+        return deployed
+
+    def gc_changesets(self, max_age=3600, workers=8):
+        """Remove stale changesets of this application in all namespaces."""
+        max_age, workers = int(max_age), int(workers)
+
+        candidates = self.deployed_stacks()
+        logging.info(f"Looking for changesets in {len(candidates)} stacks.")
+
+        def list_stale(stack_name):
+            stack = candidates[stack_name]
             try:
-                logging.info(f"{name} delete step started.")
-                step["delete"]()
-                logging.info(f"{name} delete step finished.")
-            except Exception as err:
-                logging.warning(f"{name} delete step failed with: {err}")
-                break
+                changesets = stack.stale_changesets(stack_name, max_age)
+            except ClientError as error:
+                logging.warning(f"Failed to list changesets: {error}")
+                return []
+            return [(stack_name, changeset) for changeset in changesets]
+
+        def delete(item):
+            stack_name, changeset = item
+            try:
+                self.cfn.delete_change_set(
+                    ChangeSetName=changeset, StackName=stack_name
+                )
+            except ClientError as error:
+                # It might have been removed by a deployment in the meantime.
+                logging.warning(f"Failed to remove {changeset}: {error}")
+                return False
+            return True
+
+        found = parallel_map(list_stale, sorted(candidates), workers)
+        stale = [item for items in found for item in items]
+        logging.info(f"Found {len(stale)} stale changesets.")
+
+        for batch in chunks(stale, workers):
+            removed = sum(parallel_map(delete, batch, workers))
+            logging.info(f"Removed {removed} stale changesets.")
+            # Stay clear of the cloudformation API rate limit.
+            time.sleep(1)
 
     def compile_all(self):
         """Compile all cfn templates and validate them all."""
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# encoding=utf8
+"""
+Lease based locks for ennio.
+
+A lock is a small json document holding the current holder and a queue of
+waiters. Every change to the document is a conditional write, so two
+processes can never both think they have updated it. Holders and waiters
+keep their entries alive with heartbeats, entries that are not refreshed
+within `ttl` seconds are dropped, which is how abandoned locks get
+recovered.
+"""
+from pathlib import Path
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+class LockLostError(RuntimeError):
+    """Raised when the lease of a held lock could not be renewed."""
+
+
+class S3LockStore:
+    """Keep a lock document in S3, updated with conditional writes."""
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+
+    def read(self):
+        """Return the lock document and a token to update it with."""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "NoSuchKey":
+                return None, None
+            raise
+        return json.loads(response["Body"].read()), response["ETag"]
+
+    def write(self, doc, token):
+        """Write the lock document if it is unchanged since read."""
+        kwargs = {
+            "Bucket": self.bucket,
+            "Key": self.key,
+            "Body": json.dumps(doc).encode(),
+        }
+        if token is None:
+            kwargs["IfNoneMatch"] = "*"
+        else:
+            kwargs["IfMatch"] = token
+        try:
+            self.client.put_object(**kwargs)
+        except ClientError as error:
+            code = error.response["Error"]["Code"]
+            if code in ["PreconditionFailed", "ConditionalRequestConflict"]:
+                return False
+            raise
+        return True
+
+
+class FileLockStore:
+    """Keep a lock document in a local file, for tests and local runs."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read(self):
+        """Return the lock document and a token to update it with."""
+        try:
+            content = self.path.read_bytes()
+        except FileNotFoundError:
+            return None, None
+        return json.loads(content), hashlib.sha1(content).hexdigest()
+
+    def write(self, doc, token):
+        """Write the lock document if it is unchanged since read."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.path}.guard", "a") as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            if self.read()[1] != token:
+                return False
+            temp = Path(f"{self.path}.{os.getpid()}.tmp")
+            temp.write_text(json.dumps(doc))
+            os.replace(temp, self.path)
+        return True
+
+
+class LeaseLock:
+    """
+    A lease lock with FIFO queuing.
+
+    Waiters join the queue of the lock document and get the lock in the
+    order they joined. Use it as a context manager, the lease is renewed in
+    a background thread until the lock is released.
+    """
+
+    def __init__(self, store, name, ttl=60, timeout=3600):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.interval = min(ttl / 3, 10)
+        # set when the lease could not be renewed.
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _entry(self):
+        return {"owner": self.owner, "expires": time.time() + self.ttl}
+
+    def _update(self, func):
+        """
+        Apply `func` to the lock document till the write goes through.
+
+        `func` changes the document in place and returns a result for the
+        caller. Expired holder and waiters are dropped before `func` sees
+        the document.
+        """
+        while True:
+            doc, token = self.store.read()
+            if doc is None:
+                doc = {"holder": None, "queue": []}
+            now = time.time()
+            if doc["holder"] and doc["holder"]["expires"] < now:
+                holder = doc["holder"]["owner"]
+                logging.warning(f"Lock {self.name} abandoned by {holder}.")
+                doc["holder"] = None
+            doc["queue"] = [
+                waiter for waiter in doc["queue"] if waiter["expires"] >= now
+            ]
+            result = func(doc)
+            if self.store.write(doc, token):
+                return result, doc
+
+    def _try_acquire(self, doc):
+        owners = [waiter["owner"] for waiter in doc["queue"]]
+        if self.owner not in owners:
+            doc["queue"].append(self._entry())
+            owners.append(self.owner)
+
+        if doc["holder"] is None and owners[0] == self.owner:
+            doc["holder"] = self._entry()
+            doc["queue"] = doc["queue"][1:]
+            return True
+
+        # Refresh our place in the queue.
+        doc["queue"] = [
+            self._entry() if waiter["owner"] == self.owner else waiter
+            for waiter in doc["queue"]
+        ]
+        return False
+
+    def acquire(self):
+        """Wait in the queue till we hold the lock."""
+        start = time.time()
+        while True:
+            acquired, doc = self._update(self._try_acquire)
+            if acquired:
+                break
+            holder = (doc["holder"] or {}).get("owner")
+            if time.time() - start > self.timeout:
+                self._update(self._leave)
+                raise RuntimeError(
+                    f"Timeout waiting for lock {self.name} in {self.timeout} "
+                    f"seconds, held by {holder}."
+                )
+            owners = [waiter["owner"] for waiter in doc["queue"]]
+            logging.info(
+                f"Waiting for lock {self.name}, held by {holder}, "
+                f"position in queue: {owners.index(self.owner) + 1}."
+            )
+            time.sleep(self.interval)
+
+        logging.info(f"Acquired lock {self.name}.")
+        self.lost.clear()
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def _renew(self, doc):
+        if doc["holder"] is None or doc["holder"]["owner"] != self.owner:
+            return False
+        doc["holder"] = self._entry()
+        return True
+
+    def _beat(self):
+        renewed_at = time.time()
+        while not self._stop.wait(self.interval):
+            try:
+                renewed, _ = self._update(self._renew)
+            except ClientError as error:
+                logging.warning(f"Failed to renew lock {self.name}: {error}")
+                renewed = time.time() - renewed_at < self.ttl
+            else:
+                renewed_at = time.time()
+            if not renewed:
+                logging.error(f"Lost lock {self.name}, lease has expired.")
+                self.lost.set()
+                return
+
+    def check(self):
+        """Raise `LockLostError` if the lock has been lost."""
+        if self.lost.is_set():
+            raise LockLostError(f"Lost lock {self.name}, lease has expired.")
+
+    def _leave(self, doc):
+        if doc["holder"] and doc["holder"]["owner"] == self.owner:
+            doc["holder"] = None
+        doc["queue"] = [
+            waiter for waiter in doc["queue"] if waiter["owner"] != self.owner
+        ]
+
+    def release(self):
+        """Release the lock, let the next in the queue have it."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self._update(self._leave)
+        logging.info(f"Released lock {self.name}.")
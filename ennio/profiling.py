@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# encoding=utf8
+"""
+Profiler for ennio commands.
+
+Stacks of the profiled thread are sampled at a fixed interval. Each step
+gets a `<step>.folded` file, one `frame;frame;... count` line per distinct
+stack, which is what flamegraph.pl and speedscope read. Samples are also
+split into time spent in boto3, in `utils.sleep` and everything else.
+"""
+from collections import Counter
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+
+
+def frame_label(code):
+    """Label a frame by function name, file and line of definition."""
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def categorize(codes):
+    """Tell what a sampled stack, innermost frame first, is doing."""
+    for code in codes:
+        path = code.co_filename.replace(os.sep, "/")
+        if code.co_name == "sleep" and path.endswith("ennio/utils.py"):
+            return "sleep"
+        if "/botocore/" in path or "/urllib3/" in path:
+            return "boto3"
+        if "/concurrent/futures/" in path:
+            return "workers"
+    return "other"
+
+
+def stack_of(frame):
+    """Codes of a frame and its callers, innermost first."""
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    return codes
+
+
+class Profiler:
+    """Sampling profiler that writes a folded stack file per step."""
+
+    def __init__(self, directory, interval=0.01):
+        self.directory = directory
+        self.interval = interval
+        self.active = []
+        self.lock = threading.Lock()
+        self.sampler = None
+        # cpu time used by the sampler thread itself.
+        self.overhead = 0.0
+
+    def sample(self):
+        """Sample stacks of threads in active steps, runs in a thread."""
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            with self.lock:
+                for thread_id, before, stacks, categories in self.active:
+                    codes = stack_of(frames.get(thread_id))
+                    if not codes:
+                        continue
+                    folded = ";".join(frame_label(c) for c in reversed(codes))
+                    stacks[folded] += 1
+
+                    workers = []
+                    for worker_id, frame in frames.items():
+                        if worker_id in before or worker_id == thread_id:
+                            continue
+                        worker = stack_of(frame)
+                        workers.append(categorize(worker))
+                        folded = ";".join(
+                            [names.get(worker_id, "thread")]
+                            + [frame_label(c) for c in reversed(worker)]
+                        )
+                        stacks[folded] += 1
+
+                    category = categorize(codes)
+                    if category == "workers":
+                        # Waiting on workers, take on what they are doing.
+                        category = "other"
+                        for busy in ["boto3", "sleep"]:
+                            if busy in workers:
+                                category = busy
+                                break
+                    categories[category] += 1
+            self.overhead = time.thread_time()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        """Profile the code run in this context as step `name`."""
+        if self.sampler is None:
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+        # Threads started from now on belong to this step.
+        before = set(sys._current_frames()) | {self.sampler.ident}
+        entry = (threading.get_ident(), before, Counter(), Counter())
+        wall, cpu = time.perf_counter(), time.process_time()
+        overhead = self.overhead
+        with self.lock:
+            self.active.append(entry)
+        try:
+            yield
+        finally:
+            with self.lock:
+                # Entries of nested steps can be equal, compare identity.
+                self.active = [e for e in self.active if e is not entry]
+            wall = time.perf_counter() - wall
+            overhead = self.overhead - overhead
+            cpu = max(time.process_time() - cpu - overhead, 0.0)
+            self.report(name, entry[2], entry[3], wall, cpu, overhead)
+
+    def report(self, name, stacks, categories, wall, cpu, overhead):
+        """Write the folded stacks of a step and log where time went."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{name.replace('/', '_')}.folded")
+        with open(path, "w") as fobj:
+            for folded, count in stacks.most_common():
+                fobj.write(f"{folded} {count}\n")
+
+        total = sum(categories.values()) or 1
+        split = ", ".join(
+            f"{category} {wall * categories[category] / total:.1f}s"
+            for category in ["boto3", "sleep", "other"]
+        )
+        logging.info(
+            f"Profile of {name}: wall {wall:.1f}s, cpu {cpu:.1f}s, "
+            f"sampled {split}, sampler cpu {overhead:.1f}s. "
+            f"Stacks written to {path}."
+        )
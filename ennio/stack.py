@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 # encoding=utf8
 """Stack definition for ennio."""
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import collections
 import functools
+import json
 import logging
 import os
 
 from botocore.exceptions import ClientError
+import yaml
 
-from .utils import format_changes, sleep, EmptyChangeSetError, LazyBoto3Client
+from .utils import (
+    is_custom_resource,
+    is_stale_changeset,
+    load_template,
+    parallel_map,
+    sleep,
+    ChangeSummary,
+    EmptyChangeSetError,
+    LazyBoto3Client,
+)
 
 
 class EnnioStack:
@@ -17,12 +29,22 @@ class EnnioStack:
     cfn = LazyBoto3Client("cloudformation")
     ssm = LazyBoto3Client("ssm")
     log = LazyBoto3Client("logs")
+    s3 = LazyBoto3Client("s3")
+
+    # Error codes S3 gives for a snapshot that does not exist.
+    NO_SNAPSHOT = ["NoSuchKey", "404", "AccessDenied", "403"]
+    # Logs of failed custom resources are read from this long before the
+    # failure, at most `LOG_PAGES` pages of them.
+    LOG_WINDOW = timedelta(minutes=5)
+    LOG_PAGES = 10
 
     def __init__(self, app, stack_config):
         self.app = app
         self.config = stack_config
         self.name = stack_config["name"]
         self.namespace = app.namespace
+        # template and parameters of the last `deploy_stack` call.
+        self.deployment = None
 
     @property
     @functools.lru_cache(maxsize=32)
@@ -82,6 +104,7 @@ class EnnioStack:
 
     def create_changeset(self, template, params):
         """Create a changeset."""
+        # `is_stale_changeset` relies on this format.
         name = f"{self.stack_name}-{datetime.now().strftime('%F-%H-%M-%S')}"
         kwargs = {
             "StackName": self.stack_name,
@@ -90,7 +113,8 @@ class EnnioStack:
                 {"ParameterKey": param, "ParameterValue": params[param]}
                 for param in params
             ],
-            "Tags": self.app.tags,
+            "Tags": self.app.tags
+            + [{"Key": self.app.APP_TAG, "Value": self.app.name}],
             "ChangeSetName": name,
             "ChangeSetType": "UPDATE" if self.stack_exists() else "CREATE",
         }
@@ -105,14 +129,19 @@ class EnnioStack:
         self.cfn.create_change_set(**kwargs)
         return name
 
-    def describe_changeset(self, name):
-        """Wait till a changeset is available and return it's changes."""
+    def iter_changeset(self, name):
+        """
+        Wait till a changeset is available and yield it's changes.
+
+        Changes are fetched and yielded one page at a time, so huge
+        changesets never have to be held in memory at once.
+        """
         kwargs = {"ChangeSetName": name, "StackName": self.stack_name}
 
         start = datetime.now()
         while True:
             # Change set should be ready within seconds.
-            sleep(start, 60)
+            sleep(start, 60, self.app.deadline)
             response = self.cfn.describe_change_set(**kwargs)
             status = response["Status"]
             exec_status = response["ExecutionStatus"]
@@ -130,36 +159,68 @@ class EnnioStack:
                 )
 
             if status == "CREATE_COMPLETE" and exec_status == "AVAILABLE":
-                if not response.get("NextToken"):
-                    return response["Changes"]
-                changes = response["Changes"]
-                kwargs["NextToken"] = response["NextToken"]
                 break
             logging.info(f"Status of changeset is `{status}`.")
 
         while True:
-            response = self.cfn.describe_change_set(**kwargs)
-            changes += response["Changes"]
+            yield from response["Changes"]
             if not response.get("NextToken"):
                 break
             kwargs["NextToken"] = response["NextToken"]
-        return changes
+            response = self.cfn.describe_change_set(**kwargs)
+
+    def describe_changeset(self, name):
+        """Wait till a changeset is available and return it's changes."""
+        return list(self.iter_changeset(name))
+
+    def summarize_changeset(self, name, keep=False):
+        """
+        Wait till a changeset is available and return a `ChangeSummary`.
+
+        If `ENNIO_CHANGES_DIR` is set in env var, full details of every
+        change are written to `<ENNIO_CHANGES_DIR>/<name>.jsonl` as well.
+        Changes are kept in the summary only if `keep` is set.
+        """
+        artifact = None
+        if os.environ.get("ENNIO_CHANGES_DIR"):
+            artifact = os.path.join(
+                os.environ["ENNIO_CHANGES_DIR"], f"{name}.jsonl"
+            )
+
+        changes = self.iter_changeset(name)
+        # Wait for the first page before opening the artifact, so that an
+        # empty changeset leaves no file behind.
+        first = next(changes, None)
+        with ChangeSummary(name, artifact, keep) as summary:
+            if first is not None:
+                summary.add(first)
+            for change in changes:
+                summary.add(change)
+        return summary
 
     def execute_changeset(self, name, timeout):
         """Execute a changeset."""
         logging.info(f"Executing changeset `{name}`.")
+        # Leave some room for clock skew when filtering events later.
+        executed = datetime.now(timezone.utc) - timedelta(minutes=1)
         self.cfn.execute_change_set(
             ChangeSetName=name, StackName=self.stack_name
         )
 
         start = datetime.now()
-        while True:
-            sleep(start, timeout)
-            response = self.cfn.describe_stacks(StackName=self.stack_name)
-            status = response["Stacks"][0]["StackStatus"]
-            if status.endswith("FAILED") or status.endswith("COMPLETE"):
-                break
-            logging.info(f"Waiting till stack operation completes: {status}.")
+        try:
+            while True:
+                sleep(start, timeout, self.app.deadline)
+                status = self.stack_status()
+                if status.endswith("FAILED") or status.endswith("COMPLETE"):
+                    break
+                logging.info(
+                    f"Waiting till stack operation completes: {status}."
+                )
+        except RuntimeError:
+            # Timed out, leave the stack in a stable state before rollback.
+            self.cancel_update()
+            raise
 
         logging.info(f"Stack operation finished: {status}")
         bad_statuses = [
@@ -167,25 +228,290 @@ class EnnioStack:
             "ROLLBACK_COMPLETE",
             "DELETE_COMPLETE",
         ]
-        if status in bad_statuses:
-            raise RuntimeError("Failed to create/update stack.")
+        if status in bad_statuses or status.endswith("FAILED"):
+            raise RuntimeError(
+                f"Failed to create/update stack: {self.diagnose(executed)}"
+            )
 
-    def deploy_stack(self, template, params=None, timeout=3600):
-        """Deploy stack changes by creating a changeset."""
-        logging.info(f"Building/Updating {self.name} stack.")
-        if params is None:
-            params = {}
-        name = self.create_changeset(template, params)
+    def failed_events(self, stack_name, since):
+        """
+        Find failed events of a stack since `since`, oldest first.
+
+        Return them along with ids of nested stacks that have events in
+        the same period.
+        """
+        failed, nested = [], set()
+        paginator = self.cfn.get_paginator("describe_stack_events")
+        for page in paginator.paginate(StackName=stack_name):
+            # Events come newest first.
+            for event in page["StackEvents"]:
+                if event["Timestamp"] < since:
+                    return list(reversed(failed)), nested
+                physical_id = event.get("PhysicalResourceId")
+                if (
+                    event["ResourceType"] == "AWS::CloudFormation::Stack"
+                    and physical_id
+                    and physical_id != event["StackId"]
+                ):
+                    nested.add(physical_id)
+                if event["ResourceStatus"].endswith("FAILED"):
+                    failed.append(event)
+        return list(reversed(failed)), nested
+
+    def recent_logs(self, log_group, start, end, limit=20):
+        """
+        Get the last log lines of a log group between `start` and `end`.
+
+        At most `LOG_PAGES` pages are read, lines after those are dropped.
+        """
+        lines = collections.deque(maxlen=limit)
+        paginator = self.log.get_paginator("filter_log_events")
+        pages = paginator.paginate(
+            logGroupName=log_group,
+            startTime=int(start.timestamp() * 1000),
+            endTime=int(end.timestamp() * 1000),
+        )
         try:
-            changes = self.describe_changeset(name)
-        except EmptyChangeSetError:
-            logging.info(f"No change in {self.stack_name} stack.")
-            return
-        logging.info(
-            f"Changes in changeset `{name}`: \n{format_changes(changes)}"
+            for count, page in enumerate(pages, 1):
+                for event in page["events"]:
+                    lines.append(event["message"].rstrip())
+                if count == self.LOG_PAGES:
+                    logging.debug(f"Stopped reading {log_group} at {count}.")
+                    break
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "ResourceNotFoundException":
+                return []
+            raise
+        return list(lines)
+
+    def processed_template(self, stack_id):
+        """Get the processed template of a stack, None on failure."""
+        try:
+            response = self.cfn.get_template(
+                StackName=stack_id, TemplateStage="Processed"
+            )
+            return load_template(response["TemplateBody"])
+        except (ClientError, yaml.YAMLError) as error:
+            logging.warning(f"Failed to get template of {stack_id}: {error}")
+            return None
+
+    def custom_resource_log_group(self, event, template):
+        """
+        Find the log group of the lambda function behind a custom resource.
+
+        The function is found from the `ServiceToken` of the resource in
+        `template`, the template of its stack. Return None if it is not a
+        lambda.
+        """
+        resource = template.get("Resources", {})[event["LogicalResourceId"]]
+        token = resource.get("Properties", {}).get("ServiceToken")
+
+        if isinstance(token, dict) and "Fn::GetAtt" in token:
+            # Physical id of a lambda function is its name.
+            response = self.cfn.describe_stack_resource(
+                StackName=event["StackId"],
+                LogicalResourceId=token["Fn::GetAtt"][0],
+            )
+            token = response["StackResourceDetail"]["PhysicalResourceId"]
+        if not isinstance(token, str):
+            return None
+        if token.startswith("arn:"):
+            if ":lambda:" not in token or ":function:" not in token:
+                return None
+            token = token.split(":function:")[1].split(":")[0]
+        return f"/aws/lambda/{token}"
+
+    def failure_logs(self, failures, since):
+        """
+        Get logs of failed custom resources, keyed by log group.
+
+        Logs are taken from `LOG_WINDOW` before the first failure of a
+        function, but not before `since`, to a minute after its last one.
+        Templates are fetched once per stack, looking up functions and
+        fetching logs are done in parallel.
+        """
+        failures = [e for e in failures if is_custom_resource(e)]
+        stack_ids = sorted({event["StackId"] for event in failures})
+        templates = dict(
+            zip(stack_ids, parallel_map(self.processed_template, stack_ids))
+        )
+
+        def log_group(event):
+            template = templates[event["StackId"]]
+            if template is None:
+                return None
+            try:
+                return self.custom_resource_log_group(event, template)
+            except (ClientError, KeyError) as error:
+                logging.warning(f"Failed to find log group: {error}")
+                return None
+
+        windows = {}
+        for event, group in zip(failures, parallel_map(log_group, failures)):
+            if group is None:
+                continue
+            start = max(event["Timestamp"] - self.LOG_WINDOW, since)
+            end = event["Timestamp"] + timedelta(minutes=1)
+            if group in windows:
+                start = min(windows[group][0], start)
+                end = max(windows[group][1], end)
+            windows[group] = (start, end)
+
+        groups = sorted(windows)
+        logs = parallel_map(
+            lambda group: self.recent_logs(group, *windows[group]), groups
         )
-        self.execute_changeset(name, timeout)
-        return changes
+        return dict(zip(groups, logs))
+
+    def diagnose(self, since, first=3):
+        """
+        Find the root cause of a failed stack operation.
+
+        This stack and its nested stacks are walked level by level, the
+        events of each level fetched in parallel. The `first` failed events
+        of each stack are kept, and logs of the lambda functions behind
+        failed custom resources are fetched in parallel as well. A summary
+        is logged, and the reason of the earliest failure is returned.
+        """
+        try:
+            failures, seen, stacks = [], set(), [self.stack_name]
+            while stacks:
+                seen.update(stacks)
+                results = parallel_map(
+                    lambda stack: self.failed_events(stack, since), stacks
+                )
+                stacks = set()
+                for failed, nested in results:
+                    failures.extend(failed[:first])
+                    stacks.update(nested - seen)
+                stacks = sorted(stacks)
+            failures.sort(key=lambda event: event["Timestamp"])
+            logs = self.failure_logs(failures, since)
+        except ClientError as error:
+            # Diagnostics should never hide the failure itself.
+            logging.warning(f"Failed to diagnose failure: {error}")
+            return "unknown reason."
+
+        if not failures:
+            return "unknown reason."
+
+        parts = [f"Root cause of failure in {self.stack_name}:"]
+        for event in failures:
+            parts.append(
+                f"\t[{event['Timestamp']:%H:%M:%S}] {event['StackName']}/"
+                f"{event['LogicalResourceId']}({event['ResourceType']}) "
+                f"{event['ResourceStatus']}: "
+                f"{event.get('ResourceStatusReason', '')}"
+            )
+        for log_group, lines in logs.items():
+            parts.append(f"\tLast logs of {log_group}:")
+            parts.extend(f"\t\t{line}" for line in lines)
+        logging.error("\n".join(parts))
+
+        root = failures[0]
+        return (
+            f"{root['StackName']}/{root['LogicalResourceId']}: "
+            f"{root.get('ResourceStatusReason', '')}"
+        )
+
+    def stack_status(self):
+        """Get the status of this stack."""
+        response = self.cfn.describe_stacks(StackName=self.stack_name)
+        return response["Stacks"][0]["StackStatus"]
+
+    def wait_stable(self, timeout=3600):
+        """Wait till no operation is in progress on this stack."""
+        start = datetime.now()
+        while True:
+            status = self.stack_status()
+            if not status.endswith("_IN_PROGRESS"):
+                return status
+            logging.info(f"Waiting till stack is stable: {status}.")
+            sleep(start, timeout)
+
+    def cancel_update(self):
+        """Cancel an update in progress and wait till the stack is stable."""
+        if self.stack_status() == "UPDATE_IN_PROGRESS":
+            logging.warning(f"Cancelling update of {self.stack_name}.")
+            try:
+                self.cfn.cancel_update_stack(StackName=self.stack_name)
+            except ClientError as error:
+                # The update may have just finished on it's own.
+                logging.warning(f"Failed to cancel update: {error}")
+        status = self.wait_stable()
+        logging.info(f"Stack is stable: {status}.")
+
+    def stale_changesets(self, stack_name=None, max_age=3600):
+        """List ids of stale changesets in a stack, default to this stack."""
+        paginator = self.cfn.get_paginator("list_change_sets")
+        stale = []
+        for page in paginator.paginate(StackName=stack_name or self.stack_name):
+            for summary in page["Summaries"]:
+                if is_stale_changeset(summary, max_age):
+                    stale.append(summary["ChangeSetId"])
+        return stale
+
+    def clean_changesets(self, max_age=3600, extra=()):
+        """Remove stale changesets of this stack, along with `extra` ones."""
+        try:
+            stale = list(extra) + self.stale_changesets(max_age=max_age)
+            for changeset in stale:
+                self.cfn.delete_change_set(
+                    ChangeSetName=changeset, StackName=self.stack_name
+                )
+        except ClientError as error:
+            # Cleaning up is best effort, it should never fail a deployment.
+            logging.warning(f"Failed to remove stale changesets: {error}")
+            return
+        if stale:
+            logging.info(f"Removed {len(stale)} stale changeset(s).")
+
+    def deploy_stack(self, template, params=None, timeout=3600):
+        """
+        Deploy stack changes by creating a changeset.
+
+        Return the list of changes, or None when there is nothing to change.
+        Use `deploy_stack_summary` for huge changesets.
+        """
+        summary = self.deploy_stack_summary(template, params, timeout, True)
+        if summary is not None:
+            return summary.changes
+
+    def deploy_stack_summary(
+        self, template, params=None, timeout=3600, keep=False
+    ):
+        """
+        Deploy stack changes by creating a changeset.
+
+        Return a `ChangeSummary` of the executed changeset, or None when
+        there is nothing to change. Changes are kept in the summary only if
+        `keep` is set.
+        """
+        with self.app.lock(self.stack_name, "stack") as lock:
+            logging.info(f"Building/Updating {self.name} stack.")
+            if params is None:
+                params = {}
+            name = self.create_changeset(template, params)
+            self.deployment = {"template": template, "params": params}
+            if os.path.isfile(template):
+                # The file might be gone by the time the snapshot is saved.
+                with open(template, "rb") as fobj:
+                    self.deployment["body"] = fobj.read()
+            try:
+                summary = self.summarize_changeset(name, keep)
+            except EmptyChangeSetError:
+                logging.info(f"No change in {self.stack_name} stack.")
+                self.clean_changesets(extra=[name])
+                return
+            logging.info(f"Changes in changeset `{name}`: \n{summary}")
+            if lock is not None:
+                lock.check()
+            self.deployment["executed"] = True
+            try:
+                self.execute_changeset(name, timeout)
+            finally:
+                self.clean_changesets()
+            return summary
 
     def delete_stack(self):
         """Remove this stack."""
@@ -213,14 +539,108 @@ class EnnioStack:
         logging.info(f"Stack Removed: {stack_id}.")
         return stack_id
 
+    def snapshot_key(self, build):
+        """S3 key prefix of the deployment snapshot of a build."""
+        return f"ennio-snapshots/{self.stack_name}/{build}"
+
+    def save_snapshot(self, build):
+        """
+        Save template and parameters of the last deployment under `build`.
+
+        Local templates are uploaded along with the snapshot, so that a
+        rollback only needs the snapshot to replay the deployment.
+        """
+        if self.deployment is None:
+            return
+        bucket, key = self.app.bucket, self.snapshot_key(build)
+        snapshot = {
+            "template": self.deployment["template"],
+            "params": self.deployment["params"],
+        }
+        try:
+            if "body" in self.deployment:
+                self.s3.put_object(
+                    Bucket=bucket,
+                    Key=f"{key}.template",
+                    Body=self.deployment["body"],
+                    ServerSideEncryption="AES256",
+                )
+                snapshot["template"] = (
+                    f"https://{bucket}.s3.amazonaws.com/{key}.template"
+                )
+            self.s3.put_object(
+                Bucket=bucket,
+                Key=f"{key}.json",
+                Body=json.dumps(snapshot).encode(),
+                # Parameters can hold decrypted secrets from ssm.
+                ServerSideEncryption="AES256",
+            )
+        except ClientError as error:
+            # Without a snapshot, rollback falls back to `deploy`.
+            logging.warning(f"Failed to save snapshot of {build}: {error}")
+            return
+        logging.info(f"Saved snapshot of {self.stack_name} for {build}.")
+
+    def load_snapshot(self, build):
+        """Load the deployment snapshot of a build, None if not found."""
+        try:
+            response = self.s3.get_object(
+                Bucket=self.app.bucket, Key=f"{self.snapshot_key(build)}.json"
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in self.NO_SNAPSHOT:
+                raise
+            if error.response["Error"]["Code"] in ["AccessDenied", "403"]:
+                # Without `s3:ListBucket`, a missing key is access denied.
+                logging.warning(f"Snapshot of {build} not readable: {error}")
+            return None
+        return json.loads(response["Body"].read())
+
+    def copy_snapshot(self, build, new_build):
+        """Save the deployment snapshot of `build` as that of `new_build`."""
+        bucket = self.app.bucket
+        try:
+            self.s3.copy_object(
+                Bucket=bucket,
+                Key=f"{self.snapshot_key(new_build)}.json",
+                CopySource={
+                    "Bucket": bucket,
+                    "Key": f"{self.snapshot_key(build)}.json",
+                },
+                ServerSideEncryption="AES256",
+            )
+        except ClientError as error:
+            # Rollback to `new_build` falls back to `deploy` without it.
+            if error.response["Error"]["Code"] in self.NO_SNAPSHOT:
+                logging.warning(f"No snapshot of {build} to copy: {error}")
+            else:
+                logging.warning(f"Failed to copy snapshot of {build}: {error}")
+
     def rollback(self, build):
         """
         Rollback a stack to a previous version.
 
-        As build is the only parameter we need for a deployment,
-        rolling back is done by deploying the previous version.
+        When a snapshot of the previous version exists, it is replayed as is,
+        so templates and parameters do not need to be built again. Otherwise
+        rolling back is done by deploying the previous version, as it is
+        when the snapshot can not be replayed. Failures of the replayed
+        changeset itself are raised, deploying again would not fix them.
         """
-        self.deploy(build)
+        snapshot = self.load_snapshot(build)
+        if snapshot is None:
+            logging.info(f"No snapshot of {build}, deploying it again.")
+            self.deploy(build)
+            return
+        logging.info(f"Replaying snapshot of {build}.")
+        self.deployment = None
+        try:
+            self.deploy_stack_summary(snapshot["template"], snapshot["params"])
+        except Exception as err:
+            if self.deployment is not None and self.deployment.get("executed"):
+                raise
+            logging.warning(f"Failed to replay snapshot: {err}")
+            logging.info(f"Deploying {build} again.")
+            self.deploy(build)
 
     ############################################################################
     # commands
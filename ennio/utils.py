@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 # encoding=utf8
 """Utility functions in Ennio."""
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from functools import wraps
+import fnmatch
+import json
 import logging
 import os
+import re
 import sys
 import time
 
 import boto3
 from botocore.exceptions import NoCredentialsError, ClientError
+import yaml
 
 
 def setup_logging():
@@ -28,8 +34,13 @@ def setup_logging():
         logging.basicConfig(level=logging.DEBUG, **logging_kwargs)
 
 
-def sleep(start, timeout=None):
-    """sleep with increasing intervals."""
+def sleep(start, timeout=None, deadline=None):
+    """
+    sleep with increasing intervals.
+
+    `deadline` is a datetime the whole release has to finish by, sleeping
+    never goes past it.
+    """
     since_start = (datetime.now() - start).seconds
 
     if timeout is not None:
@@ -37,6 +48,11 @@ def sleep(start, timeout=None):
             raise RuntimeError(f"Operation timeout in {timeout} seconds.")
 
     interval = int((since_start ** 0.5) * 2.5) + 4
+    if deadline is not None:
+        remaining = (deadline - datetime.now()).total_seconds()
+        if remaining <= 0:
+            raise DeadlineExceededError(f"Deadline exceeded at {deadline}.")
+        interval = min(interval, int(remaining) + 1)
     logging.debug(f"Sleeping {interval} seconds.")
     time.sleep(interval)
 
@@ -61,26 +77,186 @@ def require_aws(func):
     return wrapper
 
 
+def parallel_map(func, items, workers=8):
+    """Call `func` on every item in a thread pool, return results in order."""
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+        return list(pool.map(func, items))
+
+
+def chunks(items, size):
+    """Split a list into lists of at most `size` items."""
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def match_path(path, pattern):
+    """
+    Return whether a file path matches a path pattern in config.
+
+    A pattern is either a glob, or a file or directory that `path` is in.
+    """
+    if fnmatch.fnmatch(path, pattern):
+        return True
+    pattern = pattern.rstrip("/")
+    return path == pattern or path.startswith(f"{pattern}/")
+
+
+def is_stale_changeset(summary, max_age):
+    """
+    Return whether a changeset summary from `list_change_sets` is stale.
+
+    A changeset is stale when it was created by ennio, is older than
+    `max_age` seconds and is neither being created nor executed. Executed
+    changesets are removed by cloudformation itself, so what is left are
+    the empty ones and those of aborted runs.
+    """
+    # Only names generated by `EnnioStack.create_changeset`.
+    pattern = re.escape(summary["StackName"]) + r"-\d{4}(-\d{2}){5}"
+    if not re.fullmatch(pattern, summary["ChangeSetName"]):
+        return False
+    if summary["Status"] in ["CREATE_PENDING", "CREATE_IN_PROGRESS"]:
+        return False
+    if summary["ExecutionStatus"] == "EXECUTE_IN_PROGRESS":
+        return False
+    age = datetime.now(timezone.utc) - summary["CreationTime"]
+    return age.total_seconds() > max_age
+
+
+def is_custom_resource(event):
+    """Return whether a stack event is of a custom resource."""
+    type_ = event["ResourceType"]
+    return (
+        type_.startswith("Custom::")
+        or type_ == "AWS::CloudFormation::CustomResource"
+    )
+
+
+def format_change(change):
+    """Format a single change so it will look better."""
+    change_ = change["ResourceChange"]
+    line = (
+        f"[{change_['Action'].upper()}] "
+        f"{change_['LogicalResourceId']}({change_['ResourceType']})"
+    )
+    if change_["Details"]:
+        line += f":\n\t{change_['Details']}"
+    return line
+
+
 def format_changes(changes):
     """Format changes so it will look better."""
-    parts = []
-    logging.debug(f"Detailed changes: {changes}")
-    for change in changes:
+    return "\n".join(format_change(change) for change in changes)
+
+
+class ChangeSummary:
+    """
+    Compact summary of a changeset, built one change at a time.
+
+    Nested stacks can produce thousands of changes, so unless `keep` is
+    set, we never keep the changes themselves around: only counts by action
+    and resource type, and (logical id, type, replacement) of the resources
+    that need replacement. When `artifact` is given, every change is also
+    appended to that file as a line of json as it arrives.
+    """
+
+    def __init__(self, name, artifact=None, keep=False):
+        self.name = name
+        self.artifact = artifact
+        self.total = 0
+        self.actions = Counter()
+        self.types = Counter()
+        self.replacements = []
+        self.changes = [] if keep else None
+        self._fobj = None
+
+    def __enter__(self):
+        if self.artifact is not None:
+            os.makedirs(os.path.dirname(self.artifact) or ".", exist_ok=True)
+            self._fobj = open(self.artifact, "w")
+        return self
+
+    def __exit__(self, *args):
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+
+    def add(self, change):
+        """Account for a single change."""
         change_ = change["ResourceChange"]
-        line = (
-            f"[{change_['Action'].upper()}] "
-            f"{change_['LogicalResourceId']}({change_['ResourceType']})"
+        self.total += 1
+        self.actions[change_["Action"]] += 1
+        self.types[(change_["Action"], change_["ResourceType"])] += 1
+        if change_.get("Replacement") in ["True", "Conditional"]:
+            self.replacements.append(
+                (
+                    change_["LogicalResourceId"],
+                    change_["ResourceType"],
+                    change_["Replacement"],
+                )
+            )
+        if self.changes is not None:
+            self.changes.append(change)
+        if self._fobj is not None:
+            self._fobj.write(json.dumps(change, default=str) + "\n")
+
+    def __str__(self):
+        actions = ", ".join(
+            f"{action.upper()}: {count}"
+            for action, count in sorted(self.actions.items())
         )
-        if change_["Details"]:
-            line += f":\n\t{change_['Details']}"
-        parts.append(line)
-    return "\n".join(parts)
+        parts = [f"{self.total} change(s) in `{self.name}` ({actions})"]
+        for (action, type_), count in sorted(self.types.items()):
+            parts.append(f"\t[{action.upper()}] {type_} x {count}")
+        if self.replacements:
+            parts.append(f"{len(self.replacements)} replacement(s):")
+        for logical_id, type_, replacement in self.replacements:
+            parts.append(f"\t[REPLACE({replacement})] {logical_id}({type_})")
+        if self.artifact is not None:
+            parts.append(f"Detailed changes written to {self.artifact}.")
+        return "\n".join(parts)
+
+
+class TemplateLoader(yaml.SafeLoader):
+    """Yaml loader that understands short forms of intrinsic functions."""
+
+
+def construct_intrinsic(loader, suffix, node):
+    """Turn `!GetAtt a.b` into `{"Fn::GetAtt": ["a", "b"]}` and so on."""
+    name = "Ref" if suffix == "Ref" else f"Fn::{suffix}"
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+        if suffix == "GetAtt":
+            value = value.split(".", 1)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {name: value}
+
+
+TemplateLoader.add_multi_constructor("!", construct_intrinsic)
+
+
+def load_template(body):
+    """Load a cloudformation template body, in either json or yaml."""
+    if isinstance(body, dict):
+        return body
+    try:
+        return json.loads(body)
+    except ValueError:
+        return yaml.load(body, Loader=TemplateLoader)
 
 
 class EmptyChangeSetError(BaseException):
     """Raised when no change needed during stack updates."""
 
 
+class DeadlineExceededError(RuntimeError):
+    """Raised when a release runs past it's deadline."""
+
+
 class InvalidConfigError(BaseException):
     """Raised when we have an invalid config file."""
 
@@ -1,7 +1,10 @@
+import re
+
 from setuptools import find_packages, setup
 
 
-VERSION = "0.1.2"
+with open("ennio/__init__.py") as fobj:
+    VERSION = re.search(r'__version__ = "(.+)"', fobj.read()).group(1)
 
 
 with open("README.md") as fobj:
@@ -19,13 +22,14 @@ if __name__ == "__main__":
         long_description=long_description,
         long_description_content_type="text/markdown",
         packages=find_packages(),
-        install_requires=["PyYAML", "boto3", "jinja2"],
+        python_requires=">=3.8",
+        # conditional writes to S3 are needed by `ennio.lock`.
+        install_requires=["PyYAML", "boto3>=1.35.69", "jinja2"],
         classifiers=[
             "Development Status :: 4 - Beta",
             "License :: OSI Approved :: Apache Software License",
             "Programming Language :: Python",
             "Programming Language :: Python :: 3",
-            "Programming Language :: Python :: 3.6",
-            "Programming Language :: Python :: 3.7",
+            "Programming Language :: Python :: 3.8",
         ],
     )
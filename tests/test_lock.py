@@ -0,0 +1,88 @@
+"""Tests for ennio.lock, run against the local file store."""
+import threading
+import time
+
+import pytest
+
+from ennio.lock import FileLockStore, LeaseLock, LockLostError
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FileLockStore(tmp_path / "namespace.json")
+
+
+def wait_for(condition, timeout=5):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, "condition not met in time"
+        time.sleep(0.01)
+
+
+def queue_length(store):
+    doc, _ = store.read()
+    return len(doc["queue"]) if doc else 0
+
+
+def test_waiters_get_the_lock_in_fifo_order(store):
+    holder = LeaseLock(store, "namespace", ttl=1)
+    holder.acquire()
+
+    order = []
+
+    def wait(index):
+        with LeaseLock(store, "namespace", ttl=1, timeout=10):
+            order.append(index)
+
+    threads = []
+    for index in range(3):
+        thread = threading.Thread(target=wait, args=(index,))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: queue_length(store) == index + 1)
+
+    holder.release()
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2]
+    assert store.read()[0] == {"holder": None, "queue": []}
+
+
+def test_abandoned_lock_is_recovered(store):
+    crashed = LeaseLock(store, "namespace", ttl=0.6)
+    crashed.acquire()
+    # Stop renewing the lease without releasing, as if the process died.
+    crashed._stop.set()
+    crashed._heartbeat.join()
+
+    start = time.time()
+    with LeaseLock(store, "namespace", ttl=0.6, timeout=5) as lock:
+        assert store.read()[0]["holder"]["owner"] == lock.owner
+    assert time.time() - start >= 0.5
+
+
+def test_timeout_leaves_the_queue(store):
+    with LeaseLock(store, "namespace", ttl=0.6) as holder:
+        waiter = LeaseLock(store, "namespace", ttl=0.6, timeout=0.5)
+        with pytest.raises(RuntimeError, match="Timeout waiting for lock"):
+            waiter.acquire()
+        doc, _ = store.read()
+        assert doc["holder"]["owner"] == holder.owner
+        assert doc["queue"] == []
+
+
+def test_lost_lock_is_reported(store):
+    lock = LeaseLock(store, "namespace", ttl=0.6)
+    lock.acquire()
+    lock.check()
+
+    # Someone else takes over the lock, e.g. after our lease expired.
+    _, token = store.read()
+    other = {"owner": "other", "expires": time.time() + 60}
+    assert store.write({"holder": other, "queue": []}, token)
+
+    wait_for(lock.lost.is_set)
+    with pytest.raises(LockLostError):
+        lock.check()
+    lock.release()
+    assert store.read()[0]["holder"]["owner"] == "other"